@@ -1,8 +1,12 @@
 #!/usr/bin/env python3
 
 import argparse
-import glob
-import gzip
+import concurrent.futures
+import contextlib
+import contextvars
+import errno
+import functools
+import http.client
 import os
 import re
 import shutil
@@ -12,9 +16,11 @@ import sys
 import tempfile
 import traceback
 import tarfile
+import threading
 import zipfile
-from io import BytesIO
-from urllib.request import urlopen
+import urllib.request
+from urllib.error import HTTPError
+from urllib.parse import urljoin, urlsplit
 
 
 class Uris:
@@ -35,6 +41,25 @@ plasticscm-mono-4.6.2.tar.gz"
 
 
 BASE = "/opt/plasticscm5"
+COPY_CHUNK_SIZE = 1024 * 1024
+MAX_REDIRECTS = 10
+USER_AGENT = "Python-urllib/{}".format(urllib.request.__version__)
+DOWNLOAD_PARTS = 4
+MIN_RANGED_DOWNLOAD_SIZE = 8 * 1024 * 1024
+VERSION_CHUNK_SIZE = 4096
+MAX_VERSION_PAGE_SIZE = 256 * 1024
+VERSION_REGEX = re.compile(rb"Version:.*\n *<span>([^ ]*)")
+CONTENT_RANGE_REGEX = re.compile(r"bytes\s+(\d+)-(\d+)/(\d+)")
+
+
+CLIENT_LAUNCHERS = frozenset([
+    "clconfigureclient",
+    "cm",
+    "gtkplastic",
+    "gtkmergetool",
+    "plasticapi",
+    "repostatscalculator",
+    "mono_setup"])
 
 
 class Paths:
@@ -44,23 +69,18 @@ class Paths:
     class Mono:
         Base = os.path.join(BASE, "mono")
         _bin = os.path.join(Base, "bin")
-        _certtools = os.path.join(BASE, "certtools")
+        CertTools = os.path.join(BASE, "certtools")
         CertSync = os.path.join(_bin, "cert-sync")
-        CertMgr = os.path.join(_certtools, "certmgr")
+        CertMgr = os.path.join(CertTools, "certmgr")
         Lib = os.path.join(Base, "lib")
-        Mozroots = os.path.join(_certtools, "mozroots")
+        Mozroots = os.path.join(CertTools, "mozroots")
 
     class Plastic:
         Theme = os.path.join(BASE, "theme")
         Client = os.path.join(BASE, "client")
-        ClientScripts = os.path.join(Client, "scripts")
         Server = os.path.join(BASE, "server")
         Cm = os.path.join(Client, "cm")
-
-    class Tmp:
-        Base = os.path.join(tempfile.gettempdir(), "plasticupdater")
-        Server = os.path.join(Base, "server")
-        Client = os.path.join(Base, "client")
+        InstalledVersion = os.path.join(BASE, ".installed-version")
 
 
 def main():
@@ -70,26 +90,26 @@ def main():
         print(
             "This installer needs to be run with administrator privileges.",
             file=sys.stderr)
-        return
+        return 1
 
     latest_version = retrieve_latest_version(args.labs)
     if latest_version is None:
         print("Unable to retrieve the latest version")
-        return
+        return 1
 
     current_version = retrieve_current_version()
     is_already_installed = current_version is not None
 
     if is_already_installed and current_version == latest_version:
         print("Already up to date.")
-        return
+        return 0
 
     if not is_already_installed:
-        do_first_install(latest_version)
-        return
+        return 0 if do_first_install(latest_version) else 1
 
     if not args.no_upgrade:
         do_upgrade(latest_version)
+    return 0
 
 
 def get_valid_args():
@@ -109,32 +129,56 @@ published in their website.")
 
 def retrieve_latest_version(use_labs):
     try:
-        with urlopen(Uris.Labs if use_labs else Uris.Download) as response:
-            html = response.read().decode("utf-8")
+        with open_url(Uris.Labs if use_labs else Uris.Download) as response:
+            return read_first_version(response)
     except Exception as e:
         print("Unable to open downloads page: {}".format(e), file=sys.stderr)
         traceback.print_stack(file=sys.stderr)
         return None
 
-    return get_first_version(html)
+
+def read_first_version(response):
+    # The version is near the top of the page: stop reading once it shows up.
+    html = bytearray()
+    while len(html) < MAX_VERSION_PAGE_SIZE:
+        chunk = response.read(VERSION_CHUNK_SIZE)
+        if not chunk:
+            return get_first_version(html)
+
+        html += chunk
+        match = VERSION_REGEX.search(html)
+        # Wait for more data if the version may be cut at the chunk boundary.
+        if match is not None and match.end(1) < len(html):
+            return match.group(1).decode("utf-8")
+
+    return None
 
 
 def get_first_version(html):
-    match = re.search("Version:.*\n *<span>([^ ]*)", html)
-    return match.group(1) if match is not None else None
+    match = VERSION_REGEX.search(html)
+    return match.group(1).decode("utf-8") if match is not None else None
 
 
 def retrieve_current_version():
+    try:
+        with open(Paths.Plastic.InstalledVersion, "r") as file:
+            return file.read().strip()
+    except FileNotFoundError:
+        pass
+
     if not os.path.isdir(BASE) or not os.path.exists(Paths.Plastic.Cm):
         return None
-    return subprocess.run(
-        [Paths.Plastic.Cm, "version"], stdout=subprocess.PIPE).stdout
+    result = subprocess.run(
+        [Paths.Plastic.Cm, "version"], stdout=subprocess.PIPE, text=True)
+    version = result.stdout.strip()
+    if result.returncode != 0 or not version:
+        return None
+    return version
 
 
-def get_tmp_dir():
-    if not os.path.isdir(Paths.Tmp.Base):
-        os.makedirs(Paths.Tmp.Base)
-    return Paths.Tmp.Base
+def save_current_version(version):
+    with open(Paths.Plastic.InstalledVersion, "w") as file:
+        file.write(version)
 
 
 def do_upgrade(version):
@@ -147,37 +191,120 @@ def do_first_install(version):
     print("Version: {}".format(version))
 
     os.makedirs(BASE, exist_ok=True)
+    # Only what this run creates may be removed if it fails.
+    new_paths = [
+        path for path in get_installed_paths() if not os.path.lexists(path)]
     try:
-        install_mono()
-        install_client(version)
-        install_server(version)
+        # Mono, client and server land in disjoint directories, so they can
+        # be downloaded and unpacked at the same time. Staging under BASE
+        # keeps the final moves on one filesystem.
+        with tempfile.TemporaryDirectory(
+                prefix=".plasticupdater-", dir=BASE) as tmp_dir:
+            run_concurrently([
+                (install_mono, ()),
+                (install_client, (version, tmp_dir)),
+                (install_server, (version, tmp_dir))])
+
+        install_git_library()
+        save_current_version(version)
     except Exception as e:
         print("Installation failed: {}".format(e), file=sys.stderr)
-        return
+        remove_partial_install(new_paths)
+        return False
 
     print("All done!")
+    return True
+
+
+def get_installed_paths():
+    return [
+        Paths.Plastic.Client,
+        Paths.Plastic.Theme,
+        Paths.Plastic.Server,
+        Paths.Mono.Base,
+        Paths.Mono.CertTools,
+    ] + [os.path.join("/usr/bin", launcher) for launcher in CLIENT_LAUNCHERS]
+
+
+def remove_partial_install(paths):
+    for path in paths:
+        if os.path.islink(path) or os.path.isfile(path):
+            os.unlink(path)
+        else:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+class Cancelled(Exception):
+    pass
+
+
+# Events checked by the work running in the current thread; any of them
+# being set means a sibling task failed and this work should stop.
+_cancel_events = contextvars.ContextVar("cancel_events", default=())
+
+
+def check_cancelled():
+    if any(event.is_set() for event in _cancel_events.get()):
+        raise Cancelled("Cancelled after another task failed")
+
+
+def copy_stream(source, output):
+    while True:
+        check_cancelled()
+        chunk = source.read(COPY_CHUNK_SIZE)
+        if not chunk:
+            return
+        # Unbuffered outputs such as the tar pipe may take only part of it.
+        data = memoryview(chunk)
+        while data:
+            data = data[output.write(data):]
+
+
+def run_concurrently(calls, max_workers=None):
+    if not calls:
+        return []
+    # Nested calls inherit the outer events, so cancelling an outer task
+    # also stops the work it started.
+    events = _cancel_events.get() + (threading.Event(),)
+
+    def run(function, args):
+        _cancel_events.set(events)
+        return function(*args)
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers or len(calls)) as executor:
+        futures = [
+            executor.submit(
+                contextvars.copy_context().run, run, function, args)
+            for function, args in calls]
+        done, pending = concurrent.futures.wait(
+            futures, return_when=concurrent.futures.FIRST_EXCEPTION)
+        if any(future.exception() is not None for future in done):
+            events[-1].set()
+            for future in pending:
+                future.cancel()
+
+    # Leaving the executor waits for the running tasks to notice the
+    # cancellation, so nothing is still writing once this returns.
+    errors = [
+        future.exception() for future in futures
+        if not future.cancelled() and future.exception() is not None]
+    if errors:
+        raise next(
+            (e for e in errors if not isinstance(e, Cancelled)), errors[0])
+    return [future.result() for future in futures]
 
 
 def install_mono():
     download_mono()
+    check_cancelled()
     update_certificates()
 
 
 def download_mono():
     print("Downloading mono from '{}'...".format(Uris.Mono))
-    try:
-        with urlopen(Uris.Mono) as response:
-            data = BytesIO(response.read())
-            mono_gzip = gzip.GzipFile(fileobj=data, mode='rb')
-
-            decompressed_data = BytesIO(mono_gzip.read())
-            downloaded_tar = tarfile.TarFile(
-                fileobj=decompressed_data, mode="r")
-
-            downloaded_tar.extractall(BASE)
-    except Exception as e:
-        shutil.rmtree(Paths.Plastic.Mono, ignore_errors=True)
-        raise
+    with open_url(Uris.Mono) as response:
+        extract_tar_gz(response, BASE)
 
 
 def update_certificates():
@@ -185,6 +312,8 @@ def update_certificates():
     if os.path.isfile(Paths.CertsFile):
         subprocess.run([Paths.Mono.CertSync, Paths.CertsFile])
 
+    # These all write to the same mono machine store, so they must not run
+    # concurrently.
     run_command(
         Paths.Mono.CertMgr,
         ["-ssl", "-m", "-y", "https://www.plasticscm.com/"])
@@ -207,8 +336,11 @@ def run_certificates_command():
 
 def run_command(name, args):
     print("Executing '{} {}'".format(name, args))
-    if subprocess.run([name] + args).returncode != 0:
-        print("Failed!", file=sys.stderr)
+    returncode = subprocess.run([name] + args).returncode
+    if returncode != 0:
+        print(
+            "Failed: '{} {}' exited with {}".format(name, args, returncode),
+            file=sys.stderr)
 
 
 def get_certificates_command():
@@ -218,66 +350,94 @@ def get_certificates_command():
     if is_command_in_path("trust"):
         return "trust", ["extract-compat"]
 
-    return None
+    return None, []
 
 
+@functools.lru_cache(maxsize=None)
 def is_command_in_path(command):
-    for path in os.environ["PATH"].split(os.pathsep):
-        path = path.strip('"')
+    return shutil.which(command)
 
-        exe_file = os.path.join(path, command)
-        if is_exe(exe_file):
-            return exe_file
 
-    return None
+def install_client(latest_version, tmp_dir):
+    print("Installing client...")
+    uri = Uris.get_client(latest_version)
+    staging_dir = os.path.join(tmp_dir, "client")
+    staged_client = os.path.join(staging_dir, "client")
+    try:
+        with download_to_temp_file(uri, ".zip", tmp_dir) as zip_path, \
+                zipfile.ZipFile(zip_path) as downloaded_zip:
+            extract_zip_entries(
+                downloaded_zip,
+                staging_dir,
+                functools.partial(get_client_entry_path, staging_dir))
+
+        check_cancelled()
+        for launcher in CLIENT_LAUNCHERS:
+            prepare_launcher(os.path.join(staged_client, launcher))
+
+        fast_move(staged_client, Paths.Plastic.Client)
+        fast_move(os.path.join(staging_dir, "theme"), Paths.Plastic.Theme)
+
+        for launcher in CLIENT_LAUNCHERS:
+            os.symlink(
+                os.path.join(Paths.Plastic.Client, launcher),
+                os.path.join("/usr/bin", launcher))
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
 
 
-def is_exe(fpath):
-    return os.path.isfile(fpath) and os.access(fpath, os.X_OK)
+def get_client_entry_path(staging_dir, name):
+    # Unpacks the bundle into its final layout: theme/ goes next to the
+    # client, and only the conf files and launchers are kept from scripts/.
+    if not name.startswith("client/"):
+        return None
+    name = name[len("client/"):]
+
+    if name.startswith("theme/"):
+        return get_entry_path(
+            os.path.join(staging_dir, "theme"), name[len("theme/"):])
+
+    client_dir = os.path.join(staging_dir, "client")
+    if name.startswith("scripts/"):
+        script = name[len("scripts/"):]
+        if "/" in script:
+            return None
+        if script.endswith(".conf") or script in CLIENT_LAUNCHERS:
+            return get_entry_path(client_dir, script)
+        return None
 
+    return get_entry_path(client_dir, name)
 
-def install_client(latest_version):
-    print("Installing client...")
+
+def install_git_library():
+    # Needs both the client and mono in place.
+    fast_move(
+        os.path.join(Paths.Plastic.Client, "gitlibs", "libgit2_x64.so"),
+        os.path.join(Paths.Mono.Lib, "libgit2_x64.so"))
+
+
+def fast_move(src, dst):
+    # os.replace would clobber a file and shutil.move would nest inside a
+    # directory; neither is wanted here.
+    if os.path.lexists(dst):
+        raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), dst)
     try:
-        temp_dir = get_tmp_dir()
-        download_zip_to_dir(Uris.get_client(latest_version), temp_dir)
-
-        shutil.move(Paths.Tmp.Client, Paths.Plastic.Client)
-        shutil.move(
-            os.path.join(Paths.Plastic.Client, "theme"), Paths.Plastic.Theme)
-
-        conf_files = glob.iglob(os.path.join(
-            Paths.Plastic.ClientScripts, "*.conf"))
-        for conf_file in conf_files:
-            shutil.move(conf_file, Paths.Plastic.Client)
-
-        launchers = [
-            "clconfigureclient",
-            "cm",
-            "gtkplastic",
-            "gtkmergetool",
-            "plasticapi"
-            "repostatscalculator"
-            "mono_setup"]
-
-        for launcher in launchers:
-            launcher_path = os.path.join(Paths.Plastic.ClientScripts, launcher)
-            shutil.move(launcher_path, Paths.Plastic.Client)
-
-            dst_path = os.path.join(Paths.Plastic.Client, launcher)
-            set_executable(dst_path)
-
-            os.symlink(dst_path, os.path.join("/usr/bin", launcher))
-            if launcher == "mono_setup":
-                replace_in_file(
-                    dst_path, "@@MONOINSTALLDIR@@", Paths.Mono.Base)
-
-        shutil.move(
-            os.path.join(Paths.Plastic.Client, "gitlibs", "libgit2_x64.so"),
-            Paths.Mono.Lib)
-        shutil.rmtree(Paths.Plastic.ClientScripts, ignore_errors=True)
-    finally:
-        shutil.rmtree(Paths.Tmp.Client, ignore_errors=True)
+        os.replace(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.move(src, dst)
+
+
+def prepare_launcher(path):
+    if not os.path.isfile(path):
+        raise Exception(
+            "The client bundle has no '{}' launcher".format(
+                os.path.basename(path)))
+
+    set_executable(path)
+    if os.path.basename(path) == "mono_setup":
+        replace_in_file(path, "@@MONOINSTALLDIR@@", Paths.Mono.Base)
 
 
 def set_executable(path):
@@ -288,41 +448,348 @@ def set_executable(path):
 
 def replace_in_file(path, search, replace):
     try:
-        filedata = None
-        with open(path, "r") as file:
+        with open(path, "r+b") as file:
             filedata = file.read()
+            if search.encode() not in filedata:
+                return
 
-        filedata = filedata.replace(search, replace)
-        with open(path, "w") as file:
-            file.write(filedata)
+            file.seek(0)
+            file.truncate()
+            file.write(filedata.replace(search.encode(), replace.encode()))
     except Exception as e:
         print(
             "Unable to replace mono install dir in mono_launcher: {}"
             .format(e), file=sys.stderr)
 
 
-def install_server(latest_version):
+def install_server(latest_version, tmp_dir):
     print("Installing server...")
+    tmp_server = os.path.join(tmp_dir, "server")
     try:
-        temp_dir = get_tmp_dir()
-        download_zip_to_dir(Uris.get_server(latest_version), temp_dir)
+        download_zip_to_dir(Uris.get_server(latest_version), tmp_dir)
+        check_cancelled()
 
-        shutil.move(Paths.Tmp.Server, Paths.Plastic.Server)
+        fast_move(tmp_server, Paths.Plastic.Server)
         # TODO the rest
     finally:
-        shutil.rmtree(Paths.Tmp.Client, ignore_errors=True)
+        shutil.rmtree(tmp_server, ignore_errors=True)
 
 
 def download_zip_to_dir(uri, output_dir):
+    with download_to_temp_file(uri, ".zip", output_dir) as zip_path:
+        extract_zip(zip_path, output_dir)
+
+
+@contextlib.contextmanager
+def download_to_temp_file(uri, suffix, tmp_dir):
     print("Downloading '{}'...".format(uri))
+    temp_file = None
     try:
-        with urlopen(uri) as response:
-            downloaded_zip = zipfile.ZipFile(BytesIO(response.read()))
-            downloaded_zip.extractall(output_dir)
-    except Exception as e:
-        print("Unable to download from {}: {}".format(uri, e), file=sys.stderr)
+        with tempfile.NamedTemporaryFile(
+                dir=tmp_dir, suffix=suffix, delete=False) as temp_file:
+            try:
+                download_to_file(uri, temp_file)
+            except Exception as e:
+                print(
+                    "Unable to download from {}: {}".format(uri, e),
+                    file=sys.stderr)
+                raise
+
+        yield temp_file.name
+    finally:
+        if temp_file is not None and os.path.exists(temp_file.name):
+            os.unlink(temp_file.name)
+
+
+class Connections:
+    _connection_types = {
+        "http": http.client.HTTPConnection,
+        "https": http.client.HTTPSConnection,
+    }
+    _idle = {}
+    _lock = threading.Lock()
+
+    def acquire(scheme, netloc):
+        with Connections._lock:
+            idle = Connections._idle.get((scheme, netloc))
+            if idle:
+                return idle.pop()
+        return Connections._connection_types[scheme](netloc)
+
+    def release(scheme, netloc, connection):
+        with Connections._lock:
+            Connections._idle.setdefault((scheme, netloc), []).append(
+                connection)
+
+
+@contextlib.contextmanager
+def open_url(uri, method="GET", headers=None):
+    scheme, netloc, connection, response = get_response(
+        uri, method, headers, MAX_REDIRECTS)
+    try:
+        yield response
+    finally:
+        if connection is None:
+            response.close()
+        elif response.isclosed():
+            Connections.release(scheme, netloc, connection)
+        else:
+            connection.close()
+
+
+def get_response(uri, method, headers, redirects_left):
+    parts = urlsplit(uri)
+    path = parts.path or "/"
+    if parts.query:
+        path += "?" + parts.query
+
+    if uses_proxy(parts.scheme, parts.hostname):
+        # Let urllib deal with the proxy, as the plain urlopen calls did.
+        request = urllib.request.Request(
+            uri, method=method, headers=get_request_headers(headers))
+        return None, None, None, urllib.request.urlopen(request)
+
+    connection = Connections.acquire(parts.scheme, parts.netloc)
+    try:
+        try:
+            response = send_request(connection, method, path, headers)
+        except (http.client.RemoteDisconnected, ConnectionError):
+            # The server may have dropped an idle keep-alive connection.
+            # Closing it makes http.client reconnect on the next request.
+            connection.close()
+            response = send_request(connection, method, path, headers)
+    except Exception:
+        connection.close()
         raise
 
+    if response.status in (301, 302, 303, 307, 308) and redirects_left > 0:
+        location = urljoin(uri, response.getheader("Location"))
+        response.read()
+        Connections.release(parts.scheme, parts.netloc, connection)
+        return get_response(location, method, headers, redirects_left - 1)
+
+    if response.status not in (200, 206):
+        connection.close()
+        raise HTTPError(
+            uri, response.status, response.reason, response.headers, None)
+
+    response.url = uri
+    return parts.scheme, parts.netloc, connection, response
+
+
+def send_request(connection, method, path, headers):
+    connection.request(method, path, headers=get_request_headers(headers))
+    return connection.getresponse()
+
+
+def get_request_headers(headers):
+    request_headers = {"User-Agent": USER_AGENT}
+    request_headers.update(headers or {})
+    return request_headers
+
+
+@functools.lru_cache(maxsize=None)
+def get_proxies():
+    return urllib.request.getproxies()
+
+
+def uses_proxy(scheme, host):
+    return scheme in get_proxies() \
+        and not urllib.request.proxy_bypass(host or "")
+
+
+def download_to_file(uri, output):
+    size, uri, validator = get_ranged_download(uri)
+    if size is not None:
+        try:
+            download_ranges(uri, output.fileno(), size, validator)
+            return
+        except (RangeDownloadError, OSError, http.client.HTTPException) as e:
+            print(
+                "Retrying '{}' as a single download: {}".format(uri, e),
+                file=sys.stderr)
+            output.seek(0)
+            output.truncate()
+
+    with open_url(uri) as response:
+        copy_stream(response, output)
+
+
+class RangeDownloadError(Exception):
+    pass
+
+
+def get_ranged_download(uri):
+    try:
+        with open_url(uri, method="HEAD") as response:
+            response.read()
+    except (OSError, http.client.HTTPException):
+        return None, uri, None
+
+    # If-Range needs a strong ETag or a Last-Modified date; without one the
+    # parts could come from different versions of the file.
+    etag = response.getheader("ETag")
+    validator = etag if etag and not etag.startswith("W/") \
+        else response.getheader("Last-Modified")
+
+    length = response.getheader("Content-Length", "")
+    if response.getheader("Accept-Ranges") != "bytes" \
+            or validator is None \
+            or not length.isdigit() \
+            or int(length) < MIN_RANGED_DOWNLOAD_SIZE:
+        return None, response.url, None
+    return int(length), response.url, validator
+
+
+def download_ranges(uri, fd, size, validator):
+    # Fetch the parts on separate connections, writing each one straight
+    # into its slot of the output file.
+    preallocate(fd, size)
+    part_size = -(-size // DOWNLOAD_PARTS)
+    run_concurrently([
+        (download_range,
+            (uri, fd, start, min(start + part_size, size) - 1, size,
+             validator))
+        for start in range(0, size, part_size)])
+
+
+def download_range(uri, fd, start, end, size, validator):
+    headers = {
+        "Range": "bytes={}-{}".format(start, end),
+        "If-Range": validator,
+    }
+    offset = start
+    with open_url(uri, headers=headers) as response:
+        # A 200 means the server ignored the range or the file changed.
+        if response.status != 206:
+            raise RangeDownloadError(
+                "Server answered {} to a range request".format(
+                    response.status))
+
+        content_range = response.getheader("Content-Range", "")
+        match = CONTENT_RANGE_REGEX.fullmatch(content_range)
+        if match is None \
+                or tuple(map(int, match.groups())) != (start, end, size):
+            raise RangeDownloadError(
+                "Unexpected Content-Range '{}'".format(content_range))
+
+        while True:
+            check_cancelled()
+            chunk = response.read(COPY_CHUNK_SIZE)
+            if not chunk:
+                break
+            data = memoryview(chunk)
+            while data:
+                written = os.pwrite(fd, data, offset)
+                data = data[written:]
+                offset += written
+
+    if offset != end + 1:
+        raise RangeDownloadError("Incomplete range {}-{}".format(start, end))
+
+
+def extract_tar_gz(stream, output_dir):
+    if not is_command_in_path("tar"):
+        with tarfile.open(
+                fileobj=stream, mode="r|gz",
+                bufsize=COPY_CHUNK_SIZE) as downloaded_tar:
+            for member in downloaded_tar:
+                check_cancelled()
+                downloaded_tar.extract(member, output_dir)
+        return
+
+    # Feed the download to tar as it arrives, so decompression and writing
+    # overlap with the network transfer.
+    command = ["tar", "-xzf", "-", "-C", output_dir]
+    with subprocess.Popen(
+            command, stdin=subprocess.PIPE, bufsize=0) as process:
+        try:
+            copy_stream(stream, process.stdin)
+        except BrokenPipeError:
+            # tar gave up early; its exit status is reported below.
+            pass
+        finally:
+            process.stdin.close()
+
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command)
+
+
+def extract_zip(path, output_dir):
+    if not is_command_in_path("unzip"):
+        with zipfile.ZipFile(path) as downloaded_zip:
+            extract_zip_entries(
+                downloaded_zip,
+                output_dir,
+                lambda name: get_entry_path(output_dir, name))
+        return
+
+    subprocess.run(["unzip", "-q", "-o", path, "-d", output_dir], check=True)
+
+
+def extract_zip_entries(downloaded_zip, root, get_target):
+    directories = set()
+    files = []
+    links = []
+    for info in downloaded_zip.infolist():
+        target = get_target(info.filename)
+        if target is None:
+            continue
+        if stat.S_ISLNK(info.external_attr >> 16):
+            directories.add(os.path.dirname(target))
+            links.append((info, target))
+        elif info.is_dir():
+            directories.add(target)
+        else:
+            directories.add(os.path.dirname(target))
+            files.append((info, target))
+
+    for directory in directories:
+        os.makedirs(directory, exist_ok=True)
+
+    def extract_entry(info, target):
+        with downloaded_zip.open(info) as source, open(target, "wb") as dst:
+            preallocate(dst.fileno(), info.file_size)
+            copy_stream(source, dst)
+
+            # Keep the unix permissions stored in the archive, as unzip does.
+            mode = stat.S_IMODE(info.external_attr >> 16)
+            if mode:
+                os.fchmod(dst.fileno(), mode)
+
+    run_concurrently(
+        [(extract_entry, entry) for entry in files],
+        max_workers=min(32, (os.cpu_count() or 1) * 4))
+
+    # Links go last so no entry is written through one, and they may only
+    # point inside root. Chained links are only resolved once all exist.
+    root = os.path.realpath(root)
+    for info, target in links:
+        os.symlink(downloaded_zip.read(info).decode(), target)
+    for info, target in links:
+        resolved = os.path.realpath(target)
+        if os.path.commonpath([root, resolved]) != root:
+            raise Exception("Unsafe link in archive: '{}' -> '{}'".format(
+                info.filename, os.readlink(target)))
+
+
+def preallocate(fd, size):
+    if size == 0 or not hasattr(os, "posix_fallocate"):
+        return
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except OSError as e:
+        if e.errno not in (errno.EOPNOTSUPP, errno.ENOSYS, errno.EINVAL):
+            raise
+
+
+def get_entry_path(output_dir, name):
+    output_dir = os.path.abspath(output_dir)
+    target = os.path.normpath(os.path.join(output_dir, name))
+    if os.path.commonpath([output_dir, target]) != output_dir:
+        raise Exception("Unsafe path in archive: '{}'".format(name))
+    return target
+
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())